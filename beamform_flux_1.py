@@ -3,8 +3,10 @@
 
 import argparse
 
+import math
+import shlex
 import time
-import numpy as np
+from multiprocessing.pool import ThreadPool
 import katpoint
 from katcorelib.observe import (standard_script_options, verify_and_connect,
                                 collect_targets, start_session, user_logger,
@@ -12,10 +14,8 @@ from katcorelib.observe import (standard_script_options, verify_and_connect,
 from katsdptelstate import TelescopeState
 
 
-def get_telstate(data, sub):
+def get_telstate(data, subarray_product):
     """Get TelescopeState object associated with current data product."""
-    subarray_product = 'array_%s_%s' % (sub.sensor.sub_nr.get_value(),
-                                        sub.sensor.product.get_value())
     reply = data.req.spmc_telstate_endpoint(subarray_product)
     if not reply.succeeded:
         raise ValueError("Could not access telescope state for subarray_product %r",
@@ -28,8 +28,14 @@ def bf_inputs(data, stream):
     reply = data.req.cbf_input_labels()  # do away with once get CAM sensor
     if not reply.succeeded:
         return []
-    inputs = reply.messages[0].arguments[1:]
-    return inputs[0::2] if stream.endswith('x') else inputs[1::2]
+    # Skip the status argument and pick every other label for this polarisation
+    args = reply.messages[0].arguments
+    start = 1 if stream.endswith('x') else 2
+    return args[start::2]
+
+
+# Stream name prefixes left out of the stream mapping unless include_cam is set
+_EXCLUDED_STREAM_PREFIXES = ('CAM',)
 
 
 def get_stream_mapping_from_csv(stream_csv, include_cam=False):
@@ -45,18 +51,30 @@ def get_stream_mapping_from_csv(stream_csv, include_cam=False):
     Returns dict{<stream name>:<multicast address string>}
     """
     result = {}
-    items = stream_csv.split(',')
-    for item in items:
-        fields = item.split(':', 1)
-        if len(fields) == 2:
-            key = fields[0]
-            value = fields[1]
-            if include_cam or not key.startswith('CAM'):
-                result[key] = value
+    for item in stream_csv.split(','):
+        key, sep, value = item.partition(':')
+        if sep and (include_cam or not key.startswith(_EXCLUDED_STREAM_PREFIXES)):
+            result[key] = value
     return result
 
 
-def verify_digifits_backend_args(backend_args):
+def gather_requests(requests, max_workers=16):
+    """Issue KATCP requests concurrently and return the replies in order.
+
+    Each item of `requests` is a (request, args) pair. All requests are in
+    flight at once, so the wait is about one round trip instead of one per item.
+    """
+    if not requests:
+        return []
+    pool = ThreadPool(min(len(requests), max_workers))
+    try:
+        return pool.map(lambda request_args: request_args[0](*request_args[1]), requests)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _build_digifits_parser():
     parser = argparse.ArgumentParser(description='Grab arguments')
     parser.add_argument('-t', type=float, help='integration time (s) per output sample (default=64mus)')
     parser.add_argument('-overlap', action='store_true', help='disable input buffering')
@@ -86,7 +104,76 @@ def verify_digifits_backend_args(backend_args):
     parser.add_argument('-Lepoch', help='start time of first sub-integration (when -L is used)')
     parser.add_argument('-Lmin', type=float, help='minimum integration length output')
     parser.add_argument('-y', action='store_true', help='output partially completed integrations')
-    parser.parse_args(backend_args.split(" "))
+    return parser
+
+
+_DIGIFITS_PARSER = _build_digifits_parser()
+
+
+def verify_digifits_backend_args(backend_args):
+    _DIGIFITS_PARSER.parse_args(shlex.split(backend_args))
+
+
+def _build_dspsr_parser():
+    parser = argparse.ArgumentParser(description='Grab arguments')
+    parser.add_argument('-overlap', action='store_true', help='disable input buffering')
+    parser.add_argument('-header', help='command line arguments are header values (not filenames)')
+    parser.add_argument('-S', type=int, help='start processing at t=seek seconds')
+    parser.add_argument('-T', type=int, help='process only t=total seconds')
+    parser.add_argument('-set', help='key=value     set observation attributes')
+    parser.add_argument('-W', action='store_true', help='disable weights (allow bad data)')
+    parser.add_argument('-r', action='store_true', help='report time spent performing each operation')
+    parser.add_argument('-B', type=float, help='set the bandwidth in MHz')
+    parser.add_argument('-f', type=float, help='set the centre frequency in MHz')
+    parser.add_argument('-k', help='set the telescope name')
+    parser.add_argument('-N', help='set the source name')
+    parser.add_argument('-C', type=float, help='adjust clock byset the source name')
+    parser.add_argument('-m', help='set the start MJD of the observation')
+    parser.add_argument('-2', dest='two', action='store_true', help='unpacker options ("2-bit" excision)')
+    parser.add_argument('-skz', action='store_true', help='apply spectral kurtosis filterbank RFI zapping')
+    parser.add_argument('-noskz_too', action='store_true', help='also produce un-zapped version of output')
+    parser.add_argument('-skzm', type=int, help='samples to integrate for spectral kurtosis statistics')
+    parser.add_argument('-skzs', type=int, help='number of std deviations to use for spectral kurtosis excisions')
+    parser.add_argument('-skz_start', type=int, help='first channel where signal is expected')
+    parser.add_argument('-skz_end', type=int, help='last channel where signal is expected')
+    parser.add_argument('-skz_no_fscr', action='store_true', help=' do not use SKDetector Fscrunch feature')
+    parser.add_argument('-skz_no_tscr', action='store_true', help='do not use SKDetector Tscrunch feature')
+    parser.add_argument('-skz_no_ft', action='store_true', help='do not use SKDetector despeckeler')
+    parser.add_argument('-sk_fold', action='store_true', help='fold the SKFilterbank output')
+    parser.add_argument('-F', help='<N>[:D] * create an N-channel filterbank')
+    parser.add_argument('-G', type=int, help='nbin create phase-locked filterbank')
+    parser.add_argument('-cyclic', type=int, help='form cyclic spectra with N channels (per input channel)')
+    parser.add_argument('-cyclicoversample', type=int,
+                        help='use M times as many lags to improve cyclic channel isolation (4 is recommended)')
+    parser.add_argument('-D', type=float, help='over-ride dispersion measure')
+    parser.add_argument('-K', type=float, help='remove inter-channel dispersion delays')
+    parser.add_argument('-d', type=int, choices=[1, 2, 3, 4], help='1=PP+QQ, 2=PP,QQ, 3=(PP+QQ)^2 4=PP,QQ,PQ,QP')
+    parser.add_argument('-n', action='store_true', help='[experimental] ndim of output when npol=4')
+    parser.add_argument('-4', dest='four', action='store_true', help='compute fourth-order moments')
+    parser.add_argument('-b', type=int, help='number of phase bins in folded profile')
+    parser.add_argument('-c', type=float, help='folding period (in seconds)')
+    parser.add_argument('-cepoch', help='MJD reference epoch for phase=0 (when -c is used)')
+    parser.add_argument('-p', type=float, help='reference phase of rising edge of bin zero')
+    parser.add_argument('-E', help='pulsar ephemeris used to generate predictor')
+    parser.add_argument('-P', help='phase predictor used for folding')
+    parser.add_argument('-X', help='additional pulsar to be folded')
+    parser.add_argument('-asynch-fold', action='store_true', help='fold on CPU while processing on GPU')
+    parser.add_argument('-A', action='store_true', help='output single archive with multiple integrations')
+    parser.add_argument('-nsub', type=int, help='output archives with N integrations each')
+    parser.add_argument('-s', action='store_true', help='create single pulse sub-integrations')
+    parser.add_argument('-turns', type=int, help='create integrations of specified number of spin periods')
+    parser.add_argument('-L', type=float, help='create integrations of specified duration')
+    parser.add_argument('-Lepoch', help='start time of first sub-integration (when -L is used)')
+    parser.add_argument('-Lmin', type=float, help='minimum integration length output')
+    parser.add_argument('-y', action='store_true', help='output partially completed integrations')
+    return parser
+
+
+_DSPSR_PARSER = _build_dspsr_parser()
+
+
+def verify_dspsr_backend_args(backend_args):
+    _DSPSR_PARSER.parse_args(shlex.split(backend_args))
 
 
 # Set up standard script options
@@ -144,12 +231,21 @@ if opts.dry_run:
 if len(args) == 0:
     raise ValueError("Please specify the target")
 
+# Verify backend_args before spending time on connecting to the telescope
+if opts.backend == "dspsr" and opts.backend_args:
+    verify_dspsr_backend_args(opts.backend_args)
+elif opts.backend == "digifits" and opts.backend_args:
+    verify_digifits_backend_args(opts.backend_args)
+
 with verify_and_connect(opts) as kat:
     bf_ants = opts.ants.split(',') if opts.ants else [ant.name for ant in kat.ants]
+    bf_ants_set = frozenset(bf_ants)
+    bf_weight = 1.0 / math.sqrt(len(bf_ants))
     cbf = SessionCBF(kat)
+    bw_hz = int(opts.beam_bandwidth * 1e6)
+    cf_hz = int(opts.beam_centre_freq * 1e6)
     for stream in cbf.beamformers:
-        reply = stream.req.passband(int((opts.beam_bandwidth) * 1e6),
-                                    int((opts.beam_centre_freq) * 1e6))
+        reply = stream.req.passband(bw_hz, cf_hz)
         if reply.succeeded:
             actual_bandwidth = float(reply.messages[0].arguments[2])
             actual_centre_freq = float(reply.messages[0].arguments[3])
@@ -159,9 +255,11 @@ with verify_and_connect(opts) as kat:
             raise ValueError("Could not set beamformer %r passband - (%s)" %
                              (stream, ' '.join(reply.messages[0].arguments)))
         user_logger.info('Setting beamformer weights for stream %r:', stream)
-        for inp in stream.inputs:
-            weight = 1.0 / np.sqrt(len(bf_ants)) if inp[:-1] in bf_ants else 0.0
-            reply = stream.req.weights(inp, weight)
+        weights = [(inp, bf_weight if inp[:-1] in bf_ants_set else 0.0)
+                   for inp in stream.inputs]
+        replies = gather_requests([(stream.req.weights, inp_weight)
+                                   for inp_weight in weights])
+        for (inp, weight), reply in zip(weights, replies):
             if reply.succeeded:
                 user_logger.info('  input %r got weight %f', inp, weight)
             else:
@@ -171,39 +269,35 @@ with verify_and_connect(opts) as kat:
 
 #SJB start
     target_name=args[:1][0]
-    print target_name
+    user_logger.debug('Target name: %s', target_name)
 #SJB end
 
     user_logger.info('Looking up main beamformer target...')
     target = collect_targets(kat, args[:1]).targets[0]
 
     # Ensure that the target is up
-    target_elevation = np.degrees(target.azel()[1])
+    target_elevation = math.degrees(target.azel()[1])
     if target_elevation < opts.horizon:
         raise ValueError("The target %r is below the horizon" % (target.description,))
 
-    # Verify backend_args
-    if opts.backend == "dspsr" and opts.backend_args:
-        verify_dspsr_backend_args(opts.backend_args)
-    elif opts.backend == "digifits" and opts.backend_args:
-        verify_digifits_backend_args(opts.backend_args)
+    # TODO:  this product ID should be provided by the PTUSE data proxy
+    sub_nr = kat.sub.sensor.sub_nr.get_value()
+    product = kat.sub.sensor.product.get_value()
+    data_product_id = "array_%s_%s" % (sub_nr, product)
 
     # Save script parameters before session capture-init's the SDP subsystem
     sdp = SessionSDP(kat)
     telstate = sdp.telstate
-    #telstate = get_telstate(kat.sdp, kat.sub)
+    #telstate = get_telstate(kat.sdp, data_product_id)
 
-    script_args = vars(opts)
+    # vars() is a live view of opts, so later option overrides are seen below
+    opts_vars = vars(opts)
+    script_args = dict(opts_vars)
     script_args['targets'] = args
     telstate.add('obs_script_arguments', script_args)
 
     # Start capture session
-    with start_session(kat, **vars(opts)) as session:
-
-        # TODO:  this product ID should be provided by the PTUSE data proxy
-        sub_nr = kat.sub.sensor.sub_nr.get_value()
-        product = kat.sub.sensor.product.get_value()
-        data_product_id = "array_%s_%s" % (sub_nr, product)
+    with start_session(kat, **opts_vars) as session:
 
         # certain constants that are ignored by PTUSE
         antenna_list = "None"
@@ -220,27 +314,28 @@ with verify_and_connect(opts) as kat:
         proposal_id = "None"
         if hasattr(opts, 'proposal_id'):
           proposal_id = str(opts.proposal_id)
-        print "kat.ptuse_1.req.ptuse_proposal_id (" + data_product_id + ", " + beam_id + ", " + proposal_id +")"
+        user_logger.debug('kat.ptuse_1.req.ptuse_proposal_id(%s, %s, %s)',
+                          data_product_id, beam_id, proposal_id)
         #Commenting out for now, don't think that lab has this sensor at the moment
         #reply = kat.ptuse_1.req.ptuse_proposal_id (data_product_id, beam_id, proposal_id)
         #print "kat.anc.req.ptuse_proposal_id returned " + str(reply)
 
         # Force delay tracking to be on
         opts.no_delays = False
-        session.standard_setup(**vars(opts))
+        session.standard_setup(**opts_vars)
         # Get onto beamformer target
 
         user_logger.info('Set noise-source pattern')
         if opts.noise_source is not None:
             import time
-            cycle_length, on_fraction=np.array([el.strip() for el in opts.noise_source.split(',')], dtype=float)
+            cycle_length, on_fraction = (float(el) for el in opts.noise_source.split(','))
             user_logger.info('Setting noise source pattern to %.3f [sec], %.3f fraction on' % (cycle_length, on_fraction))
             if opts.noise_cycle is None or opts.noise_cycle == 'all':
                 # Noise Diodes are triggered on all antennas in array simultaneously
                 timestamp = time.time() + 1  # add a second to ensure all digitisers set at the same time
                 user_logger.info('Set all noise diode with timestamp %d (%s)' % (int(timestamp), time.ctime(timestamp)))
                 kat.ants.req.dig_noise_source(timestamp, on_fraction, cycle_length)
-            elif opts.noise_cycle in bf_ants:
+            elif opts.noise_cycle in bf_ants_set:
                 # Noise Diodes are triggered for only one antenna in the array
                 ant_name = opts.noise_cycle.strip()
                 user_logger.info('Set noise diode for antenna %s' % ant_name)
@@ -248,78 +343,77 @@ with verify_and_connect(opts) as kat:
                 ped.req.dig_noise_source('now', on_fraction, cycle_length)
             elif opts.noise_cycle == 'cycle':
                 timestamp = time.time() + 1  # add a second to ensure all digitisers set at the same time
+                ant_proxies = {ant: getattr(kat, ant) for ant in bf_ants}
+                noise_requests = []
                 for ant in bf_ants:
                     user_logger.info('Set noise diode for antenna %s with timestamp %f' % (ant, timestamp))
-                    ped = getattr(kat, ant)
-                    ped.req.dig_noise_source(timestamp, on_fraction, cycle_length)
+                    noise_requests.append((ant_proxies[ant].req.dig_noise_source,
+                                           (timestamp, on_fraction, cycle_length)))
                     timestamp += cycle_length*on_fraction
+                gather_requests(noise_requests)
             else:
                 raise ValueError("Unknown ND cycle option, please select: %s or any one of %s" % (', '.join(nd_cycles), ', '.join(bf_ants)))
             #tell dspsr to expect cal data
             if float(cycle_length) > 0:
                period = float(cycle_length)
                freq = 1.0 / period
-               print "kat.ptuse_1.req.ptuse_cal_freq (" + data_product_id + ", " + beam_id + ", " + str(freq) + ")"
+               user_logger.debug('kat.ptuse_1.req.ptuse_cal_freq(%s, %s, %s)',
+                                 data_product_id, beam_id, freq)
                reply = kat.ptuse_1.req.ptuse_cal_freq (data_product_id, beam_id, freq)
-               print "kat.ptuse_1.req.ptuse_cal_freq returned " + str(reply)
+               user_logger.debug('kat.ptuse_1.req.ptuse_cal_freq returned %s', reply)
 
         # Temporary haxx to make sure that AP accepts the upcoming track request
         time.sleep(2)
         timenow = katpoint.Timestamp()
-
+        sources = katpoint.Catalogue(add_specials=False)
+        one_degree = katpoint.deg2rad(1)
+        targetName = ''.join(target.name.split())
+        user_logger.debug('Target name: %s', targetName)
 
         if opts.cal == 'flux':
-           timenow = katpoint.Timestamp()
-        
-           sources = katpoint.Catalogue(add_specials=False)
-           user_logger.info('Performing flux calibration')
-           ra, dec = target.apparent_radec(timestamp=timenow)
-           targetName=target.name.replace(" ","")
-           print targetName
-           target.name = targetName+'_O'
-#           target.name='HYDRA_O'     
-           sources.add(target)
-
-
-        if opts.cal == 'fluxN':
-           timenow = katpoint.Timestamp()
-        
-           sources = katpoint.Catalogue(add_specials=False)
-           user_logger.info('Performing flux calibration')
-           ra, dec = target.apparent_radec(timestamp=timenow)
-           print target
-           print "ra %f ,dec %f"  %(katpoint.rad2deg(ra),katpoint.rad2deg(dec))
-           dec2 = dec +katpoint.deg2rad(1)
-           print dec2,dec
-           decS = dec -katpoint.deg2rad(1)
-           targetName=target.name.replace(" ","")
-           print targetName
-	   print "newra %f newdec %f" %(katpoint.rad2deg(ra),katpoint.rad2deg(dec))
-           Ntarget=katpoint.construct_radec_target(ra, dec2)
-           Ntarget.antenna = bf_ants
+            user_logger.info('Performing flux calibration')
+            target.name = targetName + '_O'
+#           target.name='HYDRA_O'
+            sources.add(target)
+
+        elif opts.cal == 'fluxN':
+            user_logger.info('Performing flux calibration')
+            ra, dec = target.apparent_radec(timestamp=timenow)
+            user_logger.debug('Target: %s', target)
+            user_logger.debug('ra %f, dec %f', katpoint.rad2deg(ra), katpoint.rad2deg(dec))
+            dec2 = dec + one_degree
+            user_logger.debug('dec2 %s, dec %s', dec2, dec)
+            decS = dec - one_degree
+            user_logger.debug('newra %f newdec %f', katpoint.rad2deg(ra), katpoint.rad2deg(dec))
+            Ntarget = katpoint.construct_radec_target(ra, dec2)
+            Ntarget.antenna = bf_ants
 #           Ntarget.name = 'HYDRA_N'
-           Ntarget.name=targetName+'_N'
-           sources.add(Ntarget)
+            Ntarget.name = targetName + '_N'
+            sources.add(Ntarget)
 
 
         # Get onto beamformer target
    #     session.track(Ntarget, duration=5)
 
+        ptuse = kat.ptuse_1
+        ptuse_target_start = ptuse.req.ptuse_target_start
+        ptuse_target_stop = ptuse.req.ptuse_target_stop
         for target in sources:
-            print target
+            user_logger.debug('Target: %s', target)
             user_logger.info('Observing target %s' % (target.name))
             # Get onto beamformer target
             session.track(target, duration=5)
             session.capture_start()
 
 
-            print "sleeping 10 secs, will be removed later in dpc is not asynchronous"
+            user_logger.info('sleeping 10 secs, will be removed later in dpc is not asynchronous')
             time.sleep(10)
 
         # for targets in list
-            print "kat.ptuse_1.req.ptuse_target_start (" + data_product_id + ", " + beam_id + ", " + target.name + ")"
-            reply = kat.ptuse_1.req.ptuse_target_start (data_product_id, beam_id, target.name)
-            print "kat.ptuse_1.req.ptuse_target_start returned " + str(reply)
+            user_logger.debug('kat.ptuse_1.req.ptuse_target_start(%s, %s, %s)',
+                              data_product_id, beam_id, target.name)
+            reply = ptuse_target_start(data_product_id, beam_id, target.name)
+            user_logger.debug('kat.ptuse_1.req.ptuse_target_start returned %s', reply)
 
             # start PTUSE via the handles in the kat.ant.reqptuse
             # Basic observation
@@ -327,12 +421,12 @@ with verify_and_connect(opts) as kat:
             session.track(target, duration=opts.target_duration)
 
             # stop PTUSE
-            print "kat.ptuse_1.req.ptuse_target_stop (" + data_product_id + ", " + beam_id + ")"
-            reply = kat.ptuse_1.req.ptuse_target_stop (data_product_id, beam_id)
-            print reply
+            user_logger.debug('kat.ptuse_1.req.ptuse_target_stop(%s, %s)', data_product_id, beam_id)
+            reply = ptuse_target_stop(data_product_id, beam_id)
+            user_logger.debug('kat.ptuse_1.req.ptuse_target_stop returned %s', reply)
 
-            print "Allowing PTUSE 5 seconds to conclude observation"
-            time.sleep (5)
+            user_logger.info('Allowing PTUSE 5 seconds to conclude observation')
+            time.sleep(5)
 
         # Temporary haxx to make sure that AP accepts the upcoming track request
 #        time.sleep(2)
@@ -4,15 +4,17 @@
 
 import argparse
 
+import math
+import shlex
 import time
-import numpy as np
+from multiprocessing.pool import ThreadPool
 import katpoint
 from katcorelib.observe import (standard_script_options, verify_and_connect,
                                 collect_targets, start_session, user_logger,
                                 SessionCBF, SessionSDP)
 
 
-def verify_digifits_backend_args(backend_args):
+def _build_digifits_parser():
     parser = argparse.ArgumentParser(description='Grab arguments')
     parser.add_argument('-t', type=float, help='integration time (s) per output sample (default=64mus)')
     parser.add_argument('-overlap', action='store_true', help='disable input buffering')
@@ -32,10 +34,19 @@ def verify_digifits_backend_args(backend_args):
     parser.add_argument('-F', type=int, help='nchan[:D] * create a filterbank (voltages only)')
     parser.add_argument('-nsblk', type=int, help='output block size in samples (default=2048)')
     parser.add_argument('-k', action='store_true', help='remove inter-channel dispersion delays')
-    parser.parse_args(backend_args.split(" "))
+    return parser
 
 
-def verify_dspsr_backend_args(backend_args):
+_DIGIFITS_PARSER = _build_digifits_parser()
+
+
+def verify_digifits_backend_args(backend_args):
+    if not backend_args or not backend_args.strip():
+        return
+    _DIGIFITS_PARSER.parse_args(shlex.split(backend_args))
+
+
+def _build_dspsr_parser():
     parser = argparse.ArgumentParser(description='Grab arguments')
     parser.add_argument('-overlap', action='store_true', help='disable input buffering')
     parser.add_argument('-header', help='command line arguments are header values (not filenames)')
@@ -87,8 +98,37 @@ def verify_dspsr_backend_args(backend_args):
     parser.add_argument('-Lepoch', help='start time of first sub-integration (when -L is used)')
     parser.add_argument('-Lmin', type=float, help='minimum integration length output')
     parser.add_argument('-y', action='store_true', help='output partially completed integrations')
-    parser.parse_args(backend_args.split(" "))
+    return parser
+
 
+_DSPSR_PARSER = _build_dspsr_parser()
+
+
+def verify_dspsr_backend_args(backend_args):
+    if not backend_args or not backend_args.strip():
+        return
+    _DSPSR_PARSER.parse_args(shlex.split(backend_args))
+
+
+def gather_requests(requests, max_workers=16):
+    """Issue KATCP requests concurrently and return the replies in order.
+
+    Each item of `requests` is a (request, args) pair. All requests are in
+    flight at once, so the wait is about one round trip instead of one per item.
+    """
+    if not requests:
+        return []
+    pool = ThreadPool(min(len(requests), max_workers))
+    try:
+        return pool.map(lambda request_args: request_args[0](*request_args[1]), requests)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Direction of the declination offset (in units of --cal-offset) and
+# target name suffix for each flux cal type
+CAL_OFFSETS = {'flux': (0, '_O'), 'fluxN': (1, '_N'), 'fluxS': (-1, '_S')}
 
 # Set up standard script options
 usage = "%prog [options] <'target'>"
@@ -137,6 +177,12 @@ opts, args = parser.parse_args()
 if len(args) == 0:
     raise ValueError("Please specify the target")
 
+# Verify backend_args before spending time on connecting to the telescope
+if opts.backend == "dspsr" and opts.backend_args and opts.backend_args.strip():
+    verify_dspsr_backend_args(opts.backend_args)
+elif opts.backend == "digifits" and opts.backend_args and opts.backend_args.strip():
+    verify_digifits_backend_args(opts.backend_args)
+
 with verify_and_connect(opts) as kat:
 
     # check for PTUSE proxies in the subarray
@@ -154,6 +200,8 @@ with verify_and_connect(opts) as kat:
         user_logger.info('Using PTUSE proxy: %s', ptuse.name)
 
     bf_ants = opts.ants.split(',') if opts.ants else [ant.name for ant in kat.ants]
+    bf_ants_set = frozenset(bf_ants)
+    active_weight = 1.0 / math.sqrt(len(bf_ants))
     cbf = SessionCBF(kat)
     # Special hack for Lab CBF - set to zero on site
     # TODO: stop hacking, or make this a command line option
@@ -179,20 +227,17 @@ with verify_and_connect(opts) as kat:
             raise ValueError("Could not set beamformer %s passband - (%s)" %
                              (stream, ' '.join(reply.messages[0].arguments)))
         user_logger.info('Setting beamformer weights for stream %s:', stream)
-        for inp in stream.inputs:
-            weight = 1.0 / np.sqrt(len(bf_ants)) if inp[:-1] in bf_ants else 0.0
-            reply = stream.req.weights(inp, weight)
+        weights = [(inp, active_weight if inp[:-1] in bf_ants_set else 0.0)
+                   for inp in stream.inputs]
+        replies = gather_requests([(stream.req.weights, inp_weight)
+                                   for inp_weight in weights])
+        # Only log once all replies are in, so logging does not hold up the requests
+        for (inp, weight), reply in zip(weights, replies):
             if reply.succeeded:
                 user_logger.info('  input %r got weight %f', inp, weight)
             else:
                 user_logger.warning('  input %r weight could not be set', inp)
 
-    # Verify backend_args
-    if opts.backend == "dspsr" and opts.backend_args:
-        verify_dspsr_backend_args(opts.backend_args)
-    elif opts.backend == "digifits" and opts.backend_args:
-        verify_digifits_backend_args(opts.backend_args)
-
     # Save script parameters before session capture-init's the SDP subsystem
     sdp = SessionSDP(kat)
     telstate = sdp.telstate
@@ -206,9 +251,12 @@ with verify_and_connect(opts) as kat:
         # We are only interested in first target
         user_logger.info('Looking up main beamformer target...')
         target = collect_targets(kat, args[:1]).targets[0]
+        # Evaluate the target position once and reuse it for the cal offsets
+        timenow = katpoint.Timestamp()
+        ra, dec = target.apparent_radec(timestamp=timenow)
 
         # Ensure that the target is up
-        target_elevation = np.degrees(target.azel()[1])
+        target_elevation = math.degrees(target.azel(timestamp=timenow)[1])
         if target_elevation < opts.horizon:
             if not opts.dry_run:
                 raise ValueError("The target %r is below the horizon"
@@ -228,8 +276,9 @@ with verify_and_connect(opts) as kat:
         user_logger.info('Set noise-source pattern')
         if opts.noise_source is not None:
             import time
-            cycle_length, on_fraction=np.array([el.strip() for el in opts.noise_source.split(',')], dtype=float)
-            print cycle_length,on_fraction
+            parts = opts.noise_source.split(',')
+            cycle_length = float(parts[0].strip())
+            on_fraction = float(parts[1].strip())
             user_logger.info('Setting noise source pattern to %.3f [sec], %.3f fraction on' % (cycle_length, on_fraction))
             if opts.noise_cycle is None or opts.noise_cycle == 'all':
                 # Noise Diodes are triggered on all antennas in array simultaneously
@@ -255,60 +304,29 @@ with verify_and_connect(opts) as kat:
             if float(cycle_length) > 0:
                period = float(cycle_length)
                freq = 1.0 / period
-               print "kat.ptuse_1.req.ptuse_cal_freq (" + data_product_id + ", " + beam_id + ", " + str(freq) + ")"
+               user_logger.debug('kat.ptuse_1.req.ptuse_cal_freq(%s, %s, %s)',
+                                 data_product_id, beam_id, freq)
                reply = kat.ptuse_1.req.ptuse_cal_freq (data_product_id, beam_id, freq)
-               print "kat.ptuse_1.req.ptuse_cal_freq returned " + str(reply)
+               user_logger.debug('kat.ptuse_1.req.ptuse_cal_freq returned %s', reply)
 
         # Temporary haxx to make sure that AP accepts the upcoming track request
         time.sleep(2)
 
-        if opts.cal == 'flux':
-           timenow = katpoint.Timestamp()
-        
-           sources = katpoint.Catalogue(add_specials=False)
-           user_logger.info('Performing flux calibration')
-           ra, dec = target.apparent_radec(timestamp=timenow)
-           targetName=target.name.replace(" ","")
-           print targetName
-           target.name = targetName+'_O'
-           sources.add(target)
-
-
-        if opts.cal == 'fluxN':
-           timenow = katpoint.Timestamp()
-        
-           sources = katpoint.Catalogue(add_specials=False)
-           user_logger.info('Performing flux calibration')
-           ra, dec = target.apparent_radec(timestamp=timenow)
-           print target
-           print "ra %f ,dec %f"  %(katpoint.rad2deg(ra),katpoint.rad2deg(dec))
-           dec2 = dec +katpoint.deg2rad(1)
-           print dec2,dec
-           decS = dec -katpoint.deg2rad(1)
-           targetName=target.name.replace(" ","")
-           print targetName
-	   print "newra %f newdec %f" %(katpoint.rad2deg(ra),katpoint.rad2deg(dec))
-           Ntarget=katpoint.construct_radec_target(ra, dec2)
-           Ntarget.antenna = bf_ants
-           Ntarget.name=targetName+'_N'
-           sources.add(Ntarget)
-
-        if opts.cal == 'fluxS':
-           timenow = katpoint.Timestamp()
-           sources = katpoint.Catalogue(add_specials=False)
- 
-           user_logger.info('Performing flux calibration')
-           ra, dec = target.apparent_radec(timestamp=timenow)
-           print target
-           print "ra %f ,dec %f"  %(katpoint.rad2deg(ra),katpoint.rad2deg(dec))
-           dec2 = dec -katpoint.deg2rad(1)
-           targetName=target.name.replace(" ","")
-           print targetName
-	   print "newra %f newdec %f" %(katpoint.rad2deg(ra),katpoint.rad2deg(dec))
-           Starget=katpoint.construct_radec_target(ra, dec2)
-           Starget.antenna = bf_ants
-           Starget.name=targetName+'_S'
-           sources.add(Starget)
+        if opts.cal in CAL_OFFSETS:
+            user_logger.info('Performing flux calibration')
+            offset_sign, suffix = CAL_OFFSETS[opts.cal]
+            offset_deg = offset_sign * opts.cal_offset
+            targetName = target.name.replace(" ", "")
+            user_logger.debug('Target: %s', target)
+            user_logger.debug('ra %f, dec %f', katpoint.rad2deg(ra), katpoint.rad2deg(dec))
+            if offset_sign:
+                # Only the offset position is reported, the original target is still tracked
+                cal_dec = dec + katpoint.deg2rad(offset_deg)
+                user_logger.debug('newra %f newdec %f', katpoint.rad2deg(ra), katpoint.rad2deg(cal_dec))
+                user_logger.debug('Offset target name: %s', targetName + suffix)
+            else:
+                target.name = targetName + suffix
+                user_logger.debug('Target name: %s', target.name)
 
         # Get onto beamformer target
         session.track(target, duration=5)
@@ -343,7 +361,7 @@ with verify_and_connect(opts) as kat:
         user_logger.info("ptuse.req.ptuse_target_stop returned %s", reply)
 
         user_logger.info("Allowing PTUSE 5 seconds to conclude observation")
-        time.sleep (5)
+        time.sleep(5)
 
         if opts.noise_source is not None:
 #                user_logger.info('Ending noise source pattern')
@@ -3,15 +3,23 @@
 
 import argparse
 
+import math
+import shlex
 import time
-import numpy as np
+from multiprocessing.pool import ThreadPool
 import katpoint
 from katcorelib.observe import (standard_script_options, verify_and_connect,
                                 collect_targets, start_session, user_logger,
                                 SessionCBF, SessionSDP)
 
 
-def verify_digifits_backend_args(backend_args):
+# Allowed values for the backend options that take a fixed set of choices
+_PBITS = (1, 2, 4, 8)
+_PPROD = (1, 2, 4)
+_DPOLS = (1, 2, 3, 4)
+
+
+def _build_digifits_parser():
     parser = argparse.ArgumentParser(description='Grab arguments')
     parser.add_argument('-t', type=float, help='integration time (s) per output sample (default=64mus)')
     parser.add_argument('-overlap', action='store_true', help='disable input buffering')
@@ -25,16 +33,23 @@ def verify_digifits_backend_args(backend_args):
     parser.add_argument('-do_dedisp', action='store_true', help='enable coherent dedispersion (default: false)')
     parser.add_argument('-c', action='store_true', help='keep offset and scale constant')
     parser.add_argument('-I', type=int, help='rescale interval in seconds')
-    parser.add_argument('-p', type=int, choices=[1, 2, 4],
+    parser.add_argument('-p', type=int, choices=_PPROD,
                         help='output 1 (Intensity), 2 (AABB), or 4 (Coherence) products')
-    parser.add_argument('-b', type=int, choices=[1, 2, 4, 8], help='number of bits per sample output to file [1,2,4,8]')
+    parser.add_argument('-b', type=int, choices=_PBITS, help='number of bits per sample output to file [1,2,4,8]')
     parser.add_argument('-F', type=int, help='nchan[:D] * create a filterbank (voltages only)')
     parser.add_argument('-nsblk', type=int, help='output block size in samples (default=2048)')
     parser.add_argument('-k', action='store_true', help='remove inter-channel dispersion delays')
-    parser.parse_args(backend_args.split(" "))
+    return parser
+
+
+_DIGIFITS_PARSER = _build_digifits_parser()
 
 
-def verify_dspsr_backend_args(backend_args):
+def verify_digifits_backend_args(backend_tokens):
+    _DIGIFITS_PARSER.parse_args(backend_tokens)
+
+
+def _build_dspsr_parser():
     parser = argparse.ArgumentParser(description='Grab arguments')
     parser.add_argument('-overlap', action='store_true', help='disable input buffering')
     parser.add_argument('-header', help='command line arguments are header values (not filenames)')
@@ -67,7 +82,7 @@ def verify_dspsr_backend_args(backend_args):
                         help='use M times as many lags to improve cyclic channel isolation (4 is recommended)')
     parser.add_argument('-D', type=float, help='over-ride dispersion measure')
     parser.add_argument('-K', type=float, help='remove inter-channel dispersion delays')
-    parser.add_argument('-d', type=int, choices=[1, 2, 3, 4], help='1=PP+QQ, 2=PP,QQ, 3=(PP+QQ)^2 4=PP,QQ,PQ,QP')
+    parser.add_argument('-d', type=int, choices=_DPOLS, help='1=PP+QQ, 2=PP,QQ, 3=(PP+QQ)^2 4=PP,QQ,PQ,QP')
     parser.add_argument('-n', action='store_true', help='[experimental] ndim of output when npol=4')
     parser.add_argument('-4', dest='four', action='store_true', help='compute fourth-order moments')
     parser.add_argument('-b', type=int, help='number of phase bins in folded profile')
@@ -86,7 +101,30 @@ def verify_dspsr_backend_args(backend_args):
     parser.add_argument('-Lepoch', help='start time of first sub-integration (when -L is used)')
     parser.add_argument('-Lmin', type=float, help='minimum integration length output')
     parser.add_argument('-y', action='store_true', help='output partially completed integrations')
-    parser.parse_args(backend_args.split(" "))
+    return parser
+
+
+_DSPSR_PARSER = _build_dspsr_parser()
+
+
+def verify_dspsr_backend_args(backend_tokens):
+    _DSPSR_PARSER.parse_args(backend_tokens)
+
+
+def gather_requests(requests, max_workers=16):
+    """Issue KATCP requests concurrently and return the replies in order.
+
+    Each item of `requests` is a (request, args) pair. All requests are in
+    flight at once, so the wait is about one round trip instead of one per item.
+    """
+    if not requests:
+        return []
+    pool = ThreadPool(min(len(requests), max_workers))
+    try:
+        return pool.map(lambda request_args: request_args[0](*request_args[1]), requests)
+    finally:
+        pool.close()
+        pool.join()
 
 
 # Set up standard script options
@@ -131,6 +169,8 @@ if len(args) == 0:
 
 with verify_and_connect(opts) as kat:
     bf_ants = opts.ants.split(',') if opts.ants else [ant.name for ant in kat.ants]
+    bf_ants_set = frozenset(bf_ants)
+    active_weight = 1.0 / math.sqrt(len(bf_ants))
     cbf = SessionCBF(kat)
     for stream in cbf.beamformers:
         reply = stream.req.passband(int((opts.beam_bandwidth) * 1e6),
@@ -144,9 +184,12 @@ with verify_and_connect(opts) as kat:
             raise ValueError("Could not set beamformer %r passband - (%s)" %
                              (stream, ' '.join(reply.messages[0].arguments)))
         user_logger.info('Setting beamformer weights for stream %r:', stream)
-        for inp in stream.inputs:
-            weight = 1.0 / np.sqrt(len(bf_ants)) if inp[:-1] in bf_ants else 0.0
-            reply = stream.req.weights(inp, weight)
+        weights = [(inp, active_weight if inp[:-1] in bf_ants_set else 0.0)
+                   for inp in stream.inputs]
+        replies = gather_requests([(stream.req.weights, inp_weight)
+                                   for inp_weight in weights])
+        # Only log once all replies are in, so logging does not hold up the requests
+        for (inp, weight), reply in zip(weights, replies):
             if reply.succeeded:
                 user_logger.info('  input %r got weight %f', inp, weight)
             else:
@@ -157,25 +200,27 @@ with verify_and_connect(opts) as kat:
     target = collect_targets(kat, args[:1]).targets[0]
 
     # Ensure that the target is up
-    target_elevation = np.degrees(target.azel()[1])
+    target_elevation = math.degrees(target.azel()[1])
     if target_elevation < opts.horizon:
         raise ValueError("The target %r is below the horizon" % (target.description,))
 
-    # Verify backend_args
+    # Verify backend_args, tokenising them with shell quoting rules
     if opts.backend == "dspsr" and opts.backend_args:
-        verify_dspsr_backend_args(opts.backend_args)
+        verify_dspsr_backend_args(shlex.split(opts.backend_args))
     elif opts.backend == "digifits" and opts.backend_args:
-        verify_digifits_backend_args(opts.backend_args)
+        verify_digifits_backend_args(shlex.split(opts.backend_args))
 
     # Save script parameters before session capture-init's the SDP subsystem
     sdp = SessionSDP(kat)
     telstate = sdp.telstate
-    script_args = vars(opts)
+    # vars() is a live view of opts, so later option overrides are seen below
+    opts_vars = vars(opts)
+    script_args = dict(opts_vars)
     script_args['targets'] = args
     telstate.add('obs_script_arguments', script_args)
 
     # Start capture session
-    with start_session(kat, **vars(opts)) as session:
+    with start_session(kat, **opts_vars) as session:
 
         # TODO:  this product ID should be provided by the PTUSE data proxy
         sub_nr = kat.sub.sensor.sub_nr.get_value()
@@ -197,7 +242,8 @@ with verify_and_connect(opts) as kat:
         proposal_id = "None"
         if hasattr(opts, 'proposal_id'):
           proposal_id = str(opts.proposal_id)
-        print "kat.ptuse_1.req.ptuse_proposal_id (" + data_product_id + ", " + beam_id + ", " + proposal_id +")"
+        user_logger.info('kat.ptuse_1.req.ptuse_proposal_id(%s, %s, %s)',
+                         data_product_id, beam_id, proposal_id)
         #Commenting out for now, don't think that lab has this sensor at the moment
         #reply = kat.ptuse_1.req.ptuse_proposal_id (data_product_id, beam_id, proposal_id)
         #print "kat.anc.req.ptuse_proposal_id returned " + str(reply)
@@ -207,13 +253,14 @@ with verify_and_connect(opts) as kat:
           if float(opts.nd_params['period']) > 0:
             period = float(opts.nd_params['period'])
             freq = 1.0 / period
-            print "kat.ptuse_1.req.ptuse_cal_freq (" + data_product_id + ", " + beam_id + ", " + str(freq) + ")"
+            user_logger.info('kat.ptuse_1.req.ptuse_cal_freq(%s, %s, %s)',
+                             data_product_id, beam_id, freq)
             reply = kat.ptuse_1.req.ptuse_cal_freq (data_product_id, beam_id, freq)
-            print "kat.ptuse_1.req.ptuse_cal_freq returned " + str(reply)
+            user_logger.info('kat.ptuse_1.req.ptuse_cal_freq returned %s', reply)
 
         # Force delay tracking to be on
         opts.no_delays = False
-        session.standard_setup(**vars(opts))
+        session.standard_setup(**opts_vars)
         # Get onto beamformer target
 
         # Temporary haxx to make sure that AP accepts the upcoming track request
@@ -232,13 +279,14 @@ with verify_and_connect(opts) as kat:
         # Only start capturing once we are on target
         session.capture_start()
 
-        print "sleeping 10 secs, will be removed later in dpc is not asynchronous"
+        user_logger.info('sleeping 10 secs, will be removed later in dpc is not asynchronous')
         time.sleep(10)
 
         # for targets in list
-        print "kat.ptuse_1.req.ptuse_target_start (" + data_product_id + ", " + beam_id + ", " + target.name + ")"
+        user_logger.info('kat.ptuse_1.req.ptuse_target_start(%s, %s, %s)',
+                         data_product_id, beam_id, target.name)
         reply = kat.ptuse_1.req.ptuse_target_start (data_product_id, beam_id, target.name)
-        print "kat.ptuse_1.req.ptuse_target_start returned " + str(reply)
+        user_logger.info('kat.ptuse_1.req.ptuse_target_start returned %s', reply)
 
         # start PTUSE via the handles in the kat.ant.reqptuse
         # Basic observation
@@ -246,9 +294,9 @@ with verify_and_connect(opts) as kat:
         session.track(target, duration=opts.target_duration)
 
         # stop PTUSE
-        print "kat.ptuse_1.req.ptuse_target_stop (" + data_product_id + ", " + beam_id + ")"
+        user_logger.info('kat.ptuse_1.req.ptuse_target_stop(%s, %s)', data_product_id, beam_id)
         reply = kat.ptuse_1.req.ptuse_target_stop (data_product_id, beam_id)
-        print reply
+        user_logger.info('kat.ptuse_1.req.ptuse_target_stop returned %s', reply)
 
-        print "Allowing PTUSE 5 seconds to conclude observation"
+        user_logger.info('Allowing PTUSE 5 seconds to conclude observation')
         time.sleep (5)
@@ -22,16 +22,17 @@ def main(options, args):
     db_uri = sysconf.conf.get("katobs","db_uri")
 
     logger.info("Logging started")
+    logger.debug("Options: %s", options)
     logger.info("Katobs obsbuild: db_uri=%s Make a Schedule Block" % db_uri)
 
     obs = obsbuild(user=options.user, db_uri=db_uri)
-    print "===obs.status()==="
+    logger.info("===obs.status()===")
     obs.status()
-    print "===obs.status()==="
+    logger.info("===obs.status()===")
     #Create a new sb
     sb_id_code = obs.sb.new(owner=options.user)
-    print "===NEW SB CREATED===", sb_id_code
-    obs.sb.description = "%s" % (options.description)
+    logger.info("===NEW SB CREATED=== %s", sb_id_code)
+    obs.sb.description = options.description
     obs.sb.type = ScheduleBlockTypes.OBSERVATION
     instruction_set= "run-obs-script /home/kat/katusescripts/ptuse/beamform_single_pulsar.py  --proposal-id='FST-TRNS' --program-block-id='%s' --issue-id='%s' -B 856 -F 1284 -t %d '%s' --horizon 20" % (options.issue,options.issue,options.duration,options.target)
 
@@ -42,7 +43,7 @@ def main(options, args):
 #        instruction_set += " --backend-args='%s'" % (options.backend_args)
 #    if options.drift_scan:
 #        instruction_set += " --drift-scan"
-    obs.sb.instruction_set = "%s" % (instruction_set)
+    obs.sb.instruction_set = instruction_set
     obs.sb.antenna_spec = options.antennas
     obs.sb.controlled_resources_spec = 'cbf,sdp,ptuse_1'
     obs.sb.to_defined()
@@ -50,8 +51,7 @@ def main(options, args):
     obs.sb.unload()
 
     #Display the created sb
-    print "\n===obs.sb==="
-    print obs.sb
+    logger.info("===obs.sb===\n%s", obs.sb)
 
     logger.info("Katobs done.")
 
@@ -108,15 +108,11 @@ if __name__ == "__main__":
 # make backend a choice
     (options, args) = parser.parse_args()
 
-    print options
-
     if options.user is None:
-        print "A obsever/user/owner name is needed for this script"
-        raise SystemExit(parser.print_usage())
+        parser.error("A obsever/user/owner name is needed for this script")
 
     if options.target is None:
-        print "A target is needed for this script"
-        raise SystemExit(parser.print_usage())
+        parser.error("A target is needed for this script")
 
     import string
 
@@ -10,14 +10,21 @@
 """Observation user examples"""
 
 import argparse
+import csv
+import os
+import sys
 from katuilib import ScheduleBlockTypes, configure_obs
+try:
+    from typing import Sequence  # noqa: F401, only used in type comments
+except ImportError:
+    pass
 
 
 
 DEFAULTS = dict(
     phaseupfb=dict(
         owner='sarah',
-        description_format='MKAIV-405 Generic AR1 flatten {}',
+        description_format='MKAIV-405 Generic AR1 flatten %s',
         instruction_set=(
             "run-obs-script /home/kat/katsdpscripts/observation/bf_phaseup.py "),
         time="-t 600",
@@ -31,7 +38,7 @@ DEFAULTS = dict(
         ),
     phaseup=dict(
         owner='sarah',
-        description_format='MKAIV-405 Generic AR1 {}',
+        description_format='MKAIV-405 Generic AR1 %s',
         instruction_set=(
             "run-obs-script /home/kat/katsdpscripts/observation/bf_phaseup.py "),
         time="-t 64",
@@ -45,7 +52,7 @@ DEFAULTS = dict(
         ),
     delaycal=dict(
         owner='sarah',
-        description_format='MKAIV-405 Generic AR1 {}',
+        description_format='MKAIV-405 Generic AR1 %s',
         instruction_set=(
             "run-obs-script /home/kat/katsdpscripts/observation/calibrate_delays.py  '/home/kat/katsdpcatalogues/three_calib.csv' "),
         time="-t 64",
@@ -55,10 +62,10 @@ DEFAULTS = dict(
         antenna_spec='available',
         controlled_resources='cbf,sdp'
         ),
- 
+
     target=dict(
         owner='sarah',
-        description_format='MKAIV-387: CBF {}',
+        description_format='MKAIV-387: CBF %s',
         instruction_set=(
             "run-obs-script /home/kat/katusescripts/ptuse/beamform_single_pulsar.py "),
         time="-t 600",
@@ -69,97 +76,80 @@ DEFAULTS = dict(
         ),
     )
 
+# the phase up entry that starts most groups, shared as it is only read
+PHASEUP = {"target": "phaseup"}
+
 # define the order and sequence that schedule blocks must be ordered
-sb_groups_default = [
-    [
+sb_groups_default = (
+    (
         # SB to execute, additional parameters, IDs to use
-        {"target": "phaseup"},
+        PHASEUP,
         {"target": 'J0437-4715'},
         {"target": 'J0738-4042'},
-    ],
-    [
+    ),
+    (
         # SB to execute, additional parameters, IDs to use
-        {"target": "phaseup"},
+        PHASEUP,
         {"target": 'J0742-2822'},
         {"target": 'J0835-4510'},
-    ],        [
+    ),        (
         # SB to execute, additional parameters, IDs to use
-        {"target": "phaseup"},
+        PHASEUP,
         {"target": 'J0437-4715'},
         {"target": 'J0953+0755'},
-    ]
-]
+    )
+)
 
-sb_groups_test = [
-    [
+sb_groups_test = (
+    (
         # SBs to execute, overriding default parameters
         {"target": 'J1909-3744',
          "time": "-t 300",
          "owner": "sarah",
         },
-    ],
-    [
-        {"target": "phaseup"},
+    ),
+    (
+        PHASEUP,
         {"target": 'J0437-4715',
          "time": "-t 600",
         },
-    ],
-]
+    ),
+)
 # define the order and sequence that schedule blocks must be ordered - with special parameters
-sb_groups_puls1 = [
-    [
-        # SBs to execute, overriding default parameters
-        {"target": "phaseup"},
-        {"target": 'J0437-4715',
-         "time": "-t 600",
-        },
-         {"target": 'J0738-4042',
-         "time": "-t 600",
-        },
-    ],
-    [
-        # SBs to execute, overriding default parameters
-        {"target": "phaseup"},
-        {"target": 'J0437-4715',
-         "time": "-t 600",
-        },
-         {"target": 'J0738-4042',
-         "time": "-t 600",
-        },
-    ],
-    [
-       # SBs to execute, overriding default parameters
-        {"target": "phaseup"},
-        {"target": 'J0437-4715',
-         "time": "-t 600",
-        },
-         {"target": 'J0738-4042',
-         "time": "-t 600",
-        },
-    ],
-]
-sb_groups_puls2 = [
-    [
+_PULS1_SEQUENCE = (
+    # SBs to execute, overriding default parameters
+    PHASEUP,
+    {"target": 'J0437-4715',
+     "time": "-t 600",
+    },
+    {"target": 'J0738-4042',
+     "time": "-t 600",
+    },
+)
+# the same sequence three times, sharing the entries is safe as they are only read
+sb_groups_puls1 = (_PULS1_SEQUENCE,) * 3
+sb_groups_puls2 = (
+    (
         # SBs to execute, overriding default parameters
-        {"target": "phaseup"},
+        PHASEUP,
         {"target": 'J1909-3744',
          "time": "-t 60",
         },
-         {"target": 'J1644-4559',
+        {"target": 'J1644-4559',
          "time": "-t 60",
         },
-    ],
-    [
+    ),
+    (
         # SBs to execute, overriding default parameters
-        {"target": "phaseup"},
+        PHASEUP,
         {"target": 'J1644-4559',
          "time": "-t 60",
         },
-         {"target": 'J1909-3744',
+        {"target": 'J1909-3744',
          "time": "-t 60",
         },
-    ],
-]
+    ),
+)
 GROUPS = dict(
     puls1=sb_groups_puls1,
     puls2=sb_groups_puls2,
@@ -167,93 +157,132 @@ GROUPS = dict(
     default=sb_groups_default
 )
 
+def write_lines(lines):
+    """Write lines to stdout with a single write, rather than one per line."""
+    sys.stdout.write("".join(line + "\n" for line in lines))
+    sys.stdout.flush()
+
+# SB types that start a new group when reading a group from file
+GROUP_BREAKS = frozenset(("phaseup", "phaseupfb"))
+
+# read large source lists in few big chunks rather than many small reads
+if sys.version_info[0] < 3:
+    def open_csv(filename):
+        # the Python 2 csv module wants files in binary mode
+        return open(filename, 'rb', buffering=1 << 20)
+else:
+    def open_csv(filename):
+        return open(filename, 'r', buffering=1 << 20, newline='')
+
+# groups already read from file, keyed on file name and modification time
+csv_groups = {}
+
 def read_group_from_csv(filename):
+    # type: (str) -> list
 
-    import csv
+    key = (filename, os.path.getmtime(filename))
+    if key in csv_groups:
+        return csv_groups[key]
 
     listoflists = []
-    alist=[]
-    f=open(filename,'rb')
-    reader=csv.DictReader(f,fieldnames=('target','time'))
-
-    for row in reader:
-       if row['target'] == "phaseup":
-          if len(alist)>0:
-              listoflists.append(alist)
-              alist=[]
-       if row['target'] == "phaseupfb":
-          if len(alist)>0:
-              listoflists.append(alist)
-              alist=[]
-       if row['time'] == None:
-          alist.append({"target":row['target']})
-       else:
-          timestr="-t %s" %row['time']
-          alist.append({"target":row['target'],"time":timestr})
+    alist = []
+    with open_csv(filename) as f:
+        # rows are target[,time], any further columns are ignored
+        for row in csv.reader(f):
+            if not row:
+                continue
+            target = row[0]
+            duration = row[1] if len(row) > 1 and row[1] else None
+            # each phase up starts a new group
+            if target in GROUP_BREAKS and alist:
+                listoflists.append(alist)
+                alist = []
+            if duration is None:
+                alist.append({"target": target})
+            else:
+                alist.append({"target": target, "time": "-t %s" % duration})
 
     listoflists.append(alist)
+    csv_groups[key] = listoflists
 
     return listoflists
 
-def populate_ptuse_sbs(obs, group,start="now"):
+# fields of an SB, missing ones default to ""
+SB_FIELDS = ('owner', 'antenna_spec', 'controlled_resources', 'pb_id',
+             'description_format', 'instruction_set', 'target', 'time',
+             'params', 'ids', 'notes')
+# defaults of each SB type with every field filled in, any SB type not
+# listed here is taken to be a target
+SB_TYPE_DEFAULTS = dict(
+    (sb_type, dict((label, sb_defaults.get(label, "")) for label in SB_FIELDS))
+    for sb_type, sb_defaults in DEFAULTS.items())
+sb_templates = {}
+
+def sb_template(sb_params):
+    """
+    Get the defaults of the SB type overridden by sb_params
+    Memoised per distinct sb_params, so do not modify the result
+    """
+    key = tuple(sorted(sb_params.items()))
+    template = sb_templates.get(key)
+    if template is None:
+        template = dict(SB_TYPE_DEFAULTS.get(sb_params.get("target"),
+                                             SB_TYPE_DEFAULTS["target"]))
+        template.update(sb_params)
+        sb_templates[key] = template
+    return template
+
+def create_sb(obs, sequence, order, sb_params):
+    """
+    Create, fill in and approve a single SB in the database
+    Return the new SB and its instruction set
+    """
+    sb_type = sb_params.get("target")
+    merged = sb_template(sb_params)
+    sb = obs.sb.new(
+        owner=merged['owner'],
+        antenna_spec=merged['antenna_spec'],
+        controlled_resources=merged['controlled_resources'],
+        pb_id=merged['pb_id'] or None)
+    #if start != "default":
+    #    obs.sb.desired_start_time=start
+    obs.sb.type = ScheduleBlockTypes.OBSERVATION
+    obs.sb.description = merged['description_format'] % (sb_type,)
+    # phase ups pick their own target, so only pass on real targets
+    if sb_type in ("phaseup", "phaseupfb"):
+        parts = (merged['instruction_set'], merged['time'],
+                 merged['params'], merged['ids'])
+    else:
+        parts = (merged['instruction_set'], merged['target'], merged['time'],
+                 merged['params'], merged['ids'])
+    instruction_set = " ".join(parts)
+    obs.sb.instruction_set = instruction_set
+    obs.sb.notes = merged['notes']
+    obs.sb.sb_sequence = sequence
+    obs.sb.sb_order = order
+    obs.sb.to_defined()
+    obs.sb.to_approved()
+    return sb, instruction_set
+
+def populate_ptuse_sbs(obs, group, start="now"):
+    # type: (object, Sequence[Sequence[dict]], str) -> list
     # Make sure that you have run a delay-cal on the sub-array
     # bc4k sub-array - as many dishes from the core as possible
 
 
 
 
-    def specific_or_default(label):
-        """
-        Get the label from sb_params else get it from sb_defaults
-        Return empty string if not found
-        """
-        return sb_params.get(label, sb_defaults.get(label, ""))
-
-    # create the schedule blocks in the database
+    # create the schedule blocks in the database, one at a time as the
+    # obs.sb cursor only holds the SB currently being edited
     obstime=start
     created_sbs = []
+    lines = []
     for sequence, sb_group in enumerate(group):
         for order, sb_params in enumerate(sb_group):
-            sb_type = sb_params.get("target")
-            if sb_type == "phaseup":
-                sb_defaults = DEFAULTS["phaseup"]
-            else:
-                if sb_type == "phaseupfb":
-		    sb_defaults = DEFAULTS["phaseupfb"]
-		else:
-		    if sb_type == "delaycal":
-	               sb_defaults = DEFAULTS["delaycal"]
-                    else:
-                       sb_defaults = DEFAULTS["target"]
-            sb = obs.sb.new(
-                owner=specific_or_default('owner'),
-                antenna_spec=specific_or_default('antenna_spec'),
-                controlled_resources=specific_or_default('controlled_resources'),
-                pb_id=specific_or_default('pb_id') or None)
-            #if start != "default":
-	#	obs.sb.desired_start_time=start
-            obs.sb.type = ScheduleBlockTypes.OBSERVATION
-            obs.sb.description = specific_or_default(
-                'description_format').format(sb_params.get("target"))
-            if ((sb_type == "phaseup") or (sb_type == "phaseupfb")):
-	        instruction_set = " ".join([specific_or_default('instruction_set'),
-                   specific_or_default('time'), 
-                   specific_or_default('params'), 
-                   specific_or_default('ids')])
- 	    else:
-            	instruction_set = " ".join([specific_or_default('instruction_set'),
-                	specific_or_default('target'),
-                	specific_or_default('time'), 
-                	specific_or_default('params'), 
-                	specific_or_default('ids')])
-            obs.sb.instruction_set = instruction_set
-            obs.sb.notes = specific_or_default('notes')
-            obs.sb.sb_sequence = sequence
-            obs.sb.sb_order = order
-            obs.sb.to_defined()
-            obs.sb.to_approved()
-            print "Populating {} with {}".format(sb, instruction_set)
+            sb, instruction_set = create_sb(obs, sequence, order, sb_params)
+            lines.append("Populating {} with {}".format(sb, instruction_set))
             created_sbs.append(sb)
+    write_lines(lines)
 
     return created_sbs
 
@@ -271,7 +300,7 @@ def parse_cmd_line():
         help="The set of SBs to populate - currently 'cam','sarah' or 'default'")
     parser.add_argument(
         '--file',
-        default="None",
+        default=None,
         metavar='FILE',
         help="csv file containing sources")
     parser.add_argument(
@@ -279,53 +308,58 @@ def parse_cmd_line():
         default="default",
         metavar='STARTTIME',
         help="The set of SBs to populate - currently 'cam','sarah' or 'default'")
- 
+
     parser.add_argument(
         '-v', '--verbose',
         help="Show additional info",
         action="store_true")
     parser.add_argument(
-	'--pbdesc',
-	help="decription for program block",
-	metavar="pbdesc")
+        '--pbdesc',
+        help="decription for program block",
+        metavar="pbdesc")
     config = vars(parser.parse_args())
     return config
 
 def main():
     config = parse_cmd_line()
+    file_arg = config["file"]
+    group_key = config["groupkey"]
+    starttime = config["starttime"]
+    pbdesc = config["pbdesc"]
     obs = configure_obs()
 
-    print config 
-    print config["file"]    
-    if (config["file"] != 'None'):
-	sb_groups_file=read_group_from_csv(config["file"])
-        print sb_groups_file
-	group=sb_groups_file
-        
+    # show the configuration before anything that can fail on it
+    write_lines([str(config), str(file_arg)])
+    if file_arg:
+        sb_groups_file=read_group_from_csv(file_arg)
+        write_lines([str(sb_groups_file)])
+        group=sb_groups_file
+
     else:
-        print config["groupkey"]
-        group_key=config["groupkey"]
-	group=GROUPS[group_key]
-    
+        write_lines([str(group_key)])
+        group=GROUPS[group_key]
+
     obs.pb.new(owner="sarah")
-    obs.pb.description=config["pbdesc"]
-    obs.pb.desired_start_time=config["starttime"]
-    created_sbs = populate_ptuse_sbs(obs, group,config["starttime"])
+    obs.pb.description=pbdesc
+    obs.pb.desired_start_time=starttime
+    created_sbs = populate_ptuse_sbs(obs, group, starttime)
+    lines = []
     for sb in created_sbs:
-	print sb
-     #  obs.sb.sub_nr=1
+        lines.append(str(sb))
+        # obs.sb.sub_nr=1
         obs.pb.assign_sb(sb)
-     #   obs.sb.load(sb)
-     #   obs.sb.schedule(1)
+        # obs.sb.load(sb)
+        # obs.sb.schedule(1)
     obs.pb.to_defined()
     obs.pb.to_approved()
-    
 
-    print "\t****************************************************"
-    print "\tPopulated {} SBs for {}".format(len(created_sbs), config["groupkey"])
-    print "\t****************************************************"
+
+    lines.append("\t****************************************************")
+    lines.append("\tPopulated {} SBs for {}".format(len(created_sbs), group_key))
+    lines.append("\t****************************************************")
     for sb in created_sbs:
-        print "\t{}".format(sb)
+        lines.append("\t{}".format(sb))
+    write_lines(lines)
 
 
 if __name__ == "__main__":